@@ -0,0 +1,48 @@
+# cython: language_level=3
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compiled WordPiece inner loop used by `tokenization.WordpieceTokenizer` when built."""
+
+
+cpdef tuple tokenize_word(dict vocab, unicode token, unicode unk_token, Py_ssize_t max_input_chars_per_word):
+    """Tokenizes a single word into a tuple of word pieces.
+
+    This is the greedy longest-match-first algorithm of `WordpieceTokenizer`, with the
+    substring slicing and vocab lookups running on C-level unicode and dict calls.
+    """
+    cdef Py_ssize_t length = len(token)
+    cdef Py_ssize_t start = 0
+    cdef Py_ssize_t end
+    cdef unicode substr
+    cdef list sub_tokens = []
+
+    if length > max_input_chars_per_word:
+        return (unk_token,)
+    while start < length:
+        end = length
+        substr = None
+        while start < end:
+            substr = token[start:end]
+            if start > 0:
+                substr = u"##" + substr
+            if substr in vocab:
+                break
+            substr = None
+            end -= 1
+        if substr is None:
+            return (unk_token,)
+        sub_tokens.append(substr)
+        start = end
+    return tuple(sub_tokens)
@@ -18,15 +18,32 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import collections
+import functools
+import itertools
 import unicodedata
 import os
 import logging
+import mmap
+import multiprocessing
+import operator
+import weakref
+
+import numpy as np
 
 from .file_utils import cached_path
 
 logger = logging.getLogger(__name__)
 
+try:
+    from tokenizers import BertWordPieceTokenizer
+except ImportError:
+    BertWordPieceTokenizer = None
+
+try:
+    from ._wordpiece import tokenize_word as _compiled_tokenize_word
+except ImportError:
+    _compiled_tokenize_word = None
+
 PRETRAINED_VOCAB_ARCHIVE_MAP = {
     'bert-base-uncased': "https://s3.amazonaws.com/models.huggingface.co/bert/bert-base-uncased-vocab.txt",
     'bert-large-uncased': "https://s3.amazonaws.com/models.huggingface.co/bert/bert-large-uncased-vocab.txt",
@@ -47,20 +64,78 @@ PRETRAINED_VOCAB_POSITIONAL_EMBEDDINGS_SIZE_MAP = {
 }
 VOCAB_NAME = 'vocab.txt'
 
+# Vocabularies loaded by `BertTokenizer`, see `_load_vocab_cached`.
+_VOCAB_CACHE = {}
+
+# Marks the nodes of the `WordpieceTokenizer` tries that end a token.
+_TRIE_END = None
+
 
 def load_vocab(vocab_file):
     """Loads a vocabulary file into a dictionary."""
-    vocab = collections.OrderedDict()
-    index = 0
-    with open(vocab_file, "r", encoding="utf-8") as reader:
-        while True:
-            token = reader.readline()
-            if not token:
-                break
-            token = token.strip()
-            vocab[token] = index
-            index += 1
-    return vocab
+    with open(vocab_file, "rb") as reader:
+        if os.fstat(reader.fileno()).st_size == 0:
+            return {}
+        with _map_file(reader.fileno()) as buffer:
+            text = buffer[:].decode("utf-8")
+    # Split lines like a file opened in text mode does (universal newlines).
+    tokens = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    if tokens[-1] == "":
+        tokens.pop()
+    return dict(zip(map(str.strip, tokens), itertools.count()))
+
+
+def _map_file(fileno):
+    """Maps a whole file read-only in memory."""
+    if hasattr(mmap, "MAP_POPULATE"):
+        # The whole file is read right away, so fault all its pages in with the mapping.
+        return mmap.mmap(fileno, 0, flags=mmap.MAP_PRIVATE | mmap.MAP_POPULATE, prot=mmap.PROT_READ)
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+
+def _load_vocab_cached(vocab_file):
+    """Loads a vocabulary file, the list of its tokens by id and its WordPiece tries,
+    once per process.
+
+    The returned dict and list are shared by every tokenizer built from the same
+    file and must not be modified in place: a change would show up in all these
+    tokenizers, without invalidating their WordPiece caches. The file is reloaded
+    when it is replaced or modified.
+    """
+    path = os.path.realpath(vocab_file)
+    stat = os.stat(path)
+    stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _VOCAB_CACHE.get(path)
+    if cached is None or cached[0] != stamp:
+        vocab = load_vocab(path)
+        cached = _VOCAB_CACHE[path] = [stamp, vocab, _invert_vocab(vocab), None]
+    # The tries are only referenced weakly so that they are freed with the last
+    # tokenizer using them.
+    tries = cached[3]() if cached[3] is not None else None
+    if tries is None:
+        tries = _WordpieceTries(cached[1])
+        cached[3] = weakref.ref(tries)
+    return cached[1], cached[2], tries
+
+
+def _invert_vocab(vocab):
+    """Builds the list of tokens indexed by their id in `vocab`."""
+    if list(vocab.values()) == list(range(len(vocab))):
+        return list(vocab)
+    # Duplicated lines in the vocabulary file leave gaps in the ids, a dict keeps
+    # rejecting them.
+    return {index: token for token, index in vocab.items()}
+
+
+def _get_items(mapping, keys):
+    """Looks up a sequence of keys in a mapping with a single `operator.itemgetter` call."""
+    if not isinstance(keys, (list, tuple)):
+        keys = list(keys)
+    if not keys:
+        return []
+    if len(keys) == 1:
+        return [mapping[keys[0]]]
+    return list(operator.itemgetter(*keys)(mapping))
 
 
 def whitespace_tokenize(text):
@@ -76,31 +151,107 @@ class BertTokenizer(object):
     """Runs end-to-end tokenization: punctuation splitting + wordpiece"""
 
     def __init__(self, vocab_file, do_lower_case=True, max_len=None,
-                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]")):
+                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]"), use_fast=False):
+        """Constructs a BertTokenizer.
+
+        Args:
+          vocab_file: Path to a one-wordpiece-per-line vocabulary file.
+          do_lower_case: Whether to lower case the input.
+          max_len: An artificial maximum length to truncate tokenized sequences to.
+          never_split: List of tokens which will never be split during tokenization.
+          use_fast: Whether to run tokenization with the Rust implementation from the
+            `tokenizers` library when it is installed and accepts the vocabulary (it
+            requires the [CLS] and [SEP] tokens). The fast backend only protects
+            its own special tokens from splitting, not a custom `never_split` list.
+        """
         if not os.path.isfile(vocab_file):
             raise ValueError(
                 "Can't find a vocabulary file at path '{}'. To load the vocabulary from a Google pretrained "
                 "model use `tokenizer = BertTokenizer.from_pretrained(PRETRAINED_MODEL_NAME)`".format(vocab_file))
-        self.vocab = load_vocab(vocab_file)
-        self.ids_to_tokens = collections.OrderedDict(
-            [(ids, tok) for tok, ids in self.vocab.items()])
+        self.vocab, self.ids_to_tokens, tries = _load_vocab_cached(vocab_file)
         self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case,
                                               never_split=never_split)
-        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab, tries=tries)
         self.max_len = max_len if max_len is not None else int(1e12)
+        self._fast = None
+        if use_fast:
+            if BertWordPieceTokenizer is None:
+                logger.warning("use_fast=True requires the `tokenizers` library (pip install tokenizers). "
+                               "Falling back to the Python tokenizer.")
+            else:
+                try:
+                    self._fast = BertWordPieceTokenizer(vocab_file, lowercase=do_lower_case)
+                except Exception as error:
+                    logger.warning("use_fast=True could not load '{}' with the `tokenizers` library ({}). "
+                                   "Falling back to the Python tokenizer.".format(vocab_file, error))
 
     def tokenize(self, text):
+        if self._fast is not None:
+            return self._fast.encode(text, add_special_tokens=False).tokens
         split_tokens = []
         for token in self.basic_tokenizer.tokenize(text):
             for sub_token in self.wordpiece_tokenizer.tokenize(token):
                 split_tokens.append(sub_token)
         return split_tokens
 
+    def tokenize_batch(self, texts, n_workers=None, chunksize=256):
+        """Tokenizes a batch of texts.
+
+        The Python tokenizer holds the GIL, so the texts are tokenized by a pool of
+        `n_workers` processes (defaults to the number of CPUs). With the fast backend
+        the batch is tokenized natively in a single call instead.
+        """
+        if self._fast is not None:
+            encodings = self._fast.encode_batch(list(texts), add_special_tokens=False)
+            return [encoding.tokens for encoding in encodings]
+        if n_workers == 1:
+            return [self.tokenize(text) for text in texts]
+        # The tokenizer is sent once to each worker instead of with every chunk.
+        with multiprocessing.Pool(n_workers, _init_tokenize_worker, (self,)) as pool:
+            return pool.map(_tokenize_in_worker, texts, chunksize)
+
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
-        ids = []
-        for token in tokens:
-            ids.append(self.vocab[token])
+        ids = _get_items(self.vocab, tokens)
+        return self._check_max_len(ids)
+
+    def convert_tokens_to_array(self, tokens):
+        """Converts a sequence of tokens into a numpy array of ids using the vocab.
+
+        The array has dtype int64 so that `torch.from_numpy` turns it into a
+        LongTensor of input ids without copying.
+        """
+        if not isinstance(tokens, (list, tuple)):
+            tokens = list(tokens)
+        ids = np.fromiter(map(self.vocab.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+        return self._check_max_len(ids)
+
+    def convert_tokens_to_ids_batch(self, batch_tokens):
+        """Converts a batch of token sequences into ids using the vocab.
+
+        The tokens of the whole batch are looked up at once and split back afterwards.
+        """
+        batch_tokens = [list(tokens) for tokens in batch_tokens]
+        ids = _get_items(self.vocab, list(itertools.chain.from_iterable(batch_tokens)))
+        batch_ids = []
+        start = 0
+        for tokens in batch_tokens:
+            end = start + len(tokens)
+            batch_ids.append(self._check_max_len(ids[start:end]))
+            start = end
+        return batch_ids
+
+    def encode_batch(self, texts):
+        """Tokenizes a batch of texts and converts each of them into ids using the vocab.
+
+        With the fast backend the whole batch is encoded natively and in parallel.
+        """
+        if self._fast is None:
+            return self.convert_tokens_to_ids_batch([self.tokenize(text) for text in texts])
+        encodings = self._fast.encode_batch(list(texts), add_special_tokens=False)
+        return [self._check_max_len(encoding.ids) for encoding in encodings]
+
+    def _check_max_len(self, ids):
         if len(ids) > self.max_len:
             raise ValueError(
                 "Token indices sequence length is longer than the specified maximum "
@@ -111,10 +262,12 @@ class BertTokenizer(object):
 
     def convert_ids_to_tokens(self, ids):
         """Converts a sequence of ids in wordpiece tokens using the vocab."""
-        tokens = []
-        for i in ids:
-            tokens.append(self.ids_to_tokens[i])
-        return tokens
+        if not isinstance(ids, (list, tuple)):
+            ids = list(ids)
+        if isinstance(self.ids_to_tokens, list) and ids and (
+                min(ids) < 0 or max(ids) >= len(self.ids_to_tokens)):
+            raise KeyError(next(i for i in ids if not 0 <= i < len(self.ids_to_tokens)))
+        return _get_items(self.ids_to_tokens, ids)
 
     @classmethod
     def from_pretrained(cls, pretrained_model_name, cache_dir=None, *inputs, **kwargs):
@@ -165,120 +318,92 @@ class BasicTokenizer(object):
 
         Args:
           do_lower_case: Whether to lower case the input.
+          never_split: List of tokens which will never be split during tokenization.
         """
         self.do_lower_case = do_lower_case
-        self.never_split = never_split
+        self.never_split = frozenset(never_split)
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
-        text = self._clean_text(text)
+        split_tokens = []
+        if (self.do_lower_case and _is_ascii(text) and
+                not any(token in text for token in self.never_split)):
+            # ASCII text has no accents or CJK characters, so when no token has to be
+            # kept from lower casing, cleanup and lower casing are a single translate.
+            for token in text.translate(_ASCII_LOWER_CLEAN_TEXT_TABLE).split():
+                split_tokens.append(self._pad_punctuation(token))
+            return whitespace_tokenize(" ".join(split_tokens))
+
         # This was added on November 1st, 2018 for the multilingual and Chinese
         # models. This is also applied to the English models now, but it doesn't
         # matter since the English models were not trained on any Chinese data
         # and generally don't have any Chinese data in them (there are Chinese
         # characters in the vocabulary because Wikipedia does have some Chinese
         # words in the English Wikipedia.).
-        text = self._tokenize_chinese_chars(text)
+        text = self._clean_text(text)
         orig_tokens = whitespace_tokenize(text)
-        split_tokens = []
         for token in orig_tokens:
             if self.do_lower_case and token not in self.never_split:
                 token = token.lower()
                 token = self._run_strip_accents(token)
-            split_tokens.extend(self._run_split_on_punc(token))
+            split_tokens.append(self._pad_punctuation(token))
 
         output_tokens = whitespace_tokenize(" ".join(split_tokens))
         return output_tokens
 
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
-        text = unicodedata.normalize("NFD", text)
-        output = []
-        for char in text:
-            cat = unicodedata.category(char)
-            if cat == "Mn":
-                continue
-            output.append(char)
-        return "".join(output)
-
-    def _run_split_on_punc(self, text):
-        """Splits punctuation on a piece of text."""
-        if text in self.never_split:
-            return [text]
-        chars = list(text)
-        i = 0
-        start_new_word = True
-        output = []
-        while i < len(chars):
-            char = chars[i]
-            if _is_punctuation(char):
-                output.append([char])
-                start_new_word = True
-            else:
-                if start_new_word:
-                    output.append([])
-                start_new_word = False
-                output[-1].append(char)
-            i += 1
-
-        return ["".join(x) for x in output]
-
-    def _tokenize_chinese_chars(self, text):
-        """Adds whitespace around any CJK character."""
-        output = []
-        for char in text:
-            cp = ord(char)
-            if self._is_chinese_char(cp):
-                output.append(" ")
-                output.append(char)
-                output.append(" ")
-            else:
-                output.append(char)
-        return "".join(output)
-
-    def _is_chinese_char(self, cp):
-        """Checks whether CP is the codepoint of a CJK character."""
-        # This defines a "chinese character" as anything in the CJK Unicode block:
-        #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-        #
-        # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-        # despite its name. The modern Korean Hangul alphabet is a different block,
-        # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-        # space-separated words, so they are not treated specially and handled
-        # like the all of the other languages.
-        if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-                (cp >= 0x3400 and cp <= 0x4DBF) or  #
-                (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-                (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-                (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-                (cp >= 0x2B820 and cp <= 0x2CEAF) or
-                (cp >= 0xF900 and cp <= 0xFAFF) or  #
-                (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-            return True
+        if _is_ascii(text):
+            return text
+        return unicodedata.normalize("NFD", text).translate(_STRIP_ACCENTS_TABLE)
 
-        return False
+    def _pad_punctuation(self, text):
+        """Adds whitespace around any punctuation character of a piece of text."""
+        if text in self.never_split:
+            return text
+        return text.translate(_PUNCTUATION_TABLE)
 
     def _clean_text(self, text):
-        """Performs invalid character removal and whitespace cleanup on text."""
-        output = []
-        for char in text:
-            cp = ord(char)
-            if cp == 0 or cp == 0xfffd or _is_control(char):
-                continue
-            if _is_whitespace(char):
-                output.append(" ")
-            else:
-                output.append(char)
-        return "".join(output)
+        """Performs invalid character removal and whitespace cleanup on text, and adds
+        whitespace around any CJK character."""
+        if _is_ascii(text):
+            return text.translate(_ASCII_CLEAN_TEXT_TABLE)
+        return text.translate(_CLEAN_TEXT_TABLE)
 
 
 class WordpieceTokenizer(object):
     """Runs WordPiece tokenization."""
 
-    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100):
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100, cache_size=200000,
+                 tries=None):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        self.cache_size = cache_size
+        # Tries shared with the other tokenizers of the vocab, see `_load_vocab_cached`.
+        self._tries = tries if tries is not None else _WordpieceTries(vocab)
+        self._init_lookups()
+
+    def _init_lookups(self):
+        # The compiled extension looks the pieces up in the vocab directly and only
+        # accepts a plain dict. Otherwise the tries are only built on the first word
+        # missing from the cache.
+        self._use_compiled = _compiled_tokenize_word is not None and type(self.vocab) is dict
+        # The word pieces of a word only depend on the word itself and word frequencies
+        # are heavily skewed, so most words are served from this cache.
+        self._tokenize_word = functools.lru_cache(maxsize=self.cache_size)(self._run_wordpiece)
+
+    def __getstate__(self):
+        # The tries and the cache are rebuilt from the vocab after unpickling.
+        state = self.__dict__.copy()
+        for name in ("_tries", "_tokenize_word"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._tries = _WordpieceTries(self.vocab)
+        self._init_lookups()
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
@@ -300,36 +425,104 @@ class WordpieceTokenizer(object):
 
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
-
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
+            output_tokens.extend(self._tokenize_word(token))
+        return output_tokens
+
+    def _run_wordpiece(self, token):
+        """Tokenizes a single word into a tuple of word pieces."""
+        if self._use_compiled:
+            return _compiled_tokenize_word(self.vocab, token, self.unk_token,
+                                           self.max_input_chars_per_word)
+        if len(token) > self.max_input_chars_per_word:
+            return (self.unk_token,)
+        trie, suffix_trie = self._tries.get()
+
+        start = 0
+        sub_tokens = []
+        while start < len(token):
+            # Walk the trie once from `start` and keep the longest piece in the vocab.
+            node = trie if start == 0 else suffix_trie
+            end = None
+            for pos in range(start, len(token)):
+                node = node.get(token[pos])
+                if node is None:
                     break
-                sub_tokens.append(cur_substr)
-                start = end
+                if _TRIE_END in node:
+                    end = pos + 1
+            if end is None:
+                return (self.unk_token,)
+            sub_tokens.append(token[start:end] if start == 0 else "##" + token[start:end])
+            start = end
+        return tuple(sub_tokens)
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenize_worker(tokenizer):
+    """Keeps the tokenizer of a `BertTokenizer.tokenize_batch` worker process."""
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_in_worker(text):
+    return _worker_tokenizer.tokenize(text)
 
-            if is_bad:
-                output_tokens.append(self.unk_token)
-            else:
-                output_tokens.extend(sub_tokens)
-        return output_tokens
+
+class _WordpieceTries(object):
+    """Holds the WordPiece tries of a vocab, built on first use."""
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self._tries = None
+
+    def get(self):
+        if self._tries is None:
+            self._tries = _build_wordpiece_tries(self.vocab)
+        return self._tries
+
+
+def _build_wordpiece_tries(vocab):
+    """Builds character tries over the vocab for `WordpieceTokenizer`.
+
+    Returns a trie of all the tokens, used at the start of a word, and a trie of the
+    "##" continuation tokens with their prefix removed, used inside a word. Nodes are
+    dicts from a character to the next node and contain `_TRIE_END` if the path to
+    them spells a token.
+    """
+    trie, suffix_trie = {}, {}
+    for token in vocab:
+        roots = [(trie, token)]
+        if token.startswith("##"):
+            roots.append((suffix_trie, token[2:]))
+        for node, chars in roots:
+            for char in chars:
+                node = node.setdefault(char, {})
+            node[_TRIE_END] = True
+    return trie, suffix_trie
+
+
+def _is_chinese_char(cp):
+    """Checks whether CP is the codepoint of a CJK character."""
+    # This defines a "chinese character" as anything in the CJK Unicode block:
+    #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
+    #
+    # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
+    # despite its name. The modern Korean Hangul alphabet is a different block,
+    # as is Japanese Hiragana and Katakana. Those alphabets are used to write
+    # space-separated words, so they are not treated specially and handled
+    # like the all of the other languages.
+    if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
+            (cp >= 0x3400 and cp <= 0x4DBF) or  #
+            (cp >= 0x20000 and cp <= 0x2A6DF) or  #
+            (cp >= 0x2A700 and cp <= 0x2B73F) or  #
+            (cp >= 0x2B740 and cp <= 0x2B81F) or  #
+            (cp >= 0x2B820 and cp <= 0x2CEAF) or
+            (cp >= 0xF900 and cp <= 0xFAFF) or  #
+            (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
+        return True
+
+    return False
 
 
 def _is_whitespace(char):
@@ -370,3 +563,62 @@ def _is_punctuation(char):
     if cat.startswith("P"):
         return True
     return False
+
+
+class _TranslationTable(dict):
+    """A `str.translate` table filled on demand by applying `translate_fn` to each new
+    character, which avoids building a table over the whole Unicode range."""
+
+    def __init__(self, translate_fn):
+        super(_TranslationTable, self).__init__()
+        self.translate_fn = translate_fn
+
+    def __missing__(self, cp):
+        value = self[cp] = self.translate_fn(chr(cp))
+        return value
+
+
+def _clean_char(char):
+    """Translates a single character for `BasicTokenizer._clean_text`."""
+    cp = ord(char)
+    if cp == 0 or cp == 0xfffd or _is_control(char):
+        return None
+    if _is_whitespace(char):
+        return " "
+    if _is_chinese_char(cp):
+        return " " + char + " "
+    return char
+
+
+_CLEAN_TEXT_TABLE = _TranslationTable(_clean_char)
+_ASCII_CLEAN_TEXT_TABLE = {cp: _clean_char(chr(cp)) for cp in range(128)}
+_ASCII_LOWER_CLEAN_TEXT_TABLE = {cp: char if char is None else char.lower()
+                                 for cp, char in _ASCII_CLEAN_TEXT_TABLE.items()}
+
+
+def _strip_accent_char(char):
+    """Translates a single character for `BasicTokenizer._run_strip_accents`."""
+    if unicodedata.category(char) == "Mn":
+        return None
+    return char
+
+
+_STRIP_ACCENTS_TABLE = _TranslationTable(_strip_accent_char)
+
+
+def _pad_punctuation_char(char):
+    """Translates a single character for `BasicTokenizer._pad_punctuation`."""
+    if _is_punctuation(char):
+        return " " + char + " "
+    return char
+
+
+_PUNCTUATION_TABLE = _TranslationTable(_pad_punctuation_char)
+
+
+def _is_ascii(text):
+    """Checks whether `text` only contains ASCII characters."""
+    try:
+        return text.isascii()
+    except AttributeError:  # Python < 3.7
+        return not text or max(text) < u"\x80"
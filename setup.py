@@ -35,6 +35,16 @@ To create the package for pypi.
 """
 from setuptools import find_packages, setup
 
+try:
+    # Optional compiled WordPiece loop, the pure Python tokenizer is used without it.
+    from Cython.Build import cythonize
+    ext_modules = cythonize("pytorch_pretrained_bert/_wordpiece.pyx")
+except ImportError:
+    ext_modules = []
+for extension in ext_modules:
+    # A failed compilation (e.g. no C compiler) only skips the extension.
+    extension.optional = True
+
 setup(
     name="pytorch_pretrained_bert",
     version="0.4.0",
@@ -48,6 +58,7 @@ setup(
     url="https://github.com/huggingface/pytorch-pretrained-BERT",
     packages=find_packages(exclude=["*.tests", "*.tests.*",
                                     "tests.*", "tests"]),
+    ext_modules=ext_modules,
     install_requires=['torch>=0.4.1',
                       'numpy',
                       'boto3',
@@ -16,10 +16,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import gc
 import os
 import unittest
+import weakref
+from unittest import mock
 
+import numpy as np
+
+from pytorch_pretrained_bert import tokenization
 from pytorch_pretrained_bert.tokenization import (BertTokenizer, BasicTokenizer, WordpieceTokenizer,
+                                                  BertWordPieceTokenizer, load_vocab,
                                                   _is_whitespace, _is_control, _is_punctuation)
 
 
@@ -43,6 +51,14 @@ class TokenizationTest(unittest.TestCase):
 
         self.assertListEqual(
             tokenizer.convert_tokens_to_ids(tokens), [7, 4, 5, 10, 8, 9])
+        self.assertListEqual(
+            tokenizer.convert_ids_to_tokens([7, 4, 5, 10, 8, 9]), tokens)
+        self.assertRaises(KeyError, tokenizer.convert_ids_to_tokens, [-1])
+        self.assertRaises(KeyError, tokenizer.convert_ids_to_tokens, [3, 11])
+
+        ids = tokenizer.convert_tokens_to_array(tokens)
+        self.assertEqual(ids.dtype, np.int64)
+        self.assertListEqual(ids.tolist(), [7, 4, 5, 10, 8, 9])
 
     def test_full_tokenizer_raises_error_for_long_sequences(self):
         vocab_tokens = [
@@ -62,6 +78,146 @@ class TokenizationTest(unittest.TestCase):
         tokens = tokenizer.tokenize(u"the cat sat on the mat in the summer time .")
         self.assertRaises(ValueError, tokenizer.convert_tokens_to_ids, tokens)
 
+    def test_encode_batch(self):
+        vocab_tokens = [
+            "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+            "##ing", ","
+        ]
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+            vocab_file = vocab_writer.name
+
+        tokenizer = BertTokenizer(vocab_file, max_len=5)
+        other_tokenizer = BertTokenizer(vocab_file, do_lower_case=False)
+        os.remove(vocab_file)
+        self.assertIs(tokenizer.vocab, other_tokenizer.vocab)
+
+        self.assertListEqual(
+            tokenizer.encode_batch([u"UNwant\u00E9d", u"", u"running,wa"]),
+            [[7, 4, 5], [], [8, 9, 10, 6]])
+        self.assertRaises(ValueError, tokenizer.encode_batch, [u"unwanted, running"])
+        self.assertIs(tokenizer.wordpiece_tokenizer._tries, other_tokenizer.wordpiece_tokenizer._tries)
+
+        self.assertListEqual(
+            tokenizer.convert_tokens_to_ids_batch([["un"], [], ["runn", "##ing", ","]]),
+            [[7], [], [8, 9, 10]])
+        self.assertListEqual(tokenizer.convert_tokens_to_ids(["wa"]), [6])
+
+        # The shared tries are freed with the last tokenizer of the vocab.
+        tries = weakref.ref(tokenizer.wordpiece_tokenizer._tries)
+        del tokenizer
+        gc.collect()
+        self.assertIsNotNone(tries())
+        del other_tokenizer
+        gc.collect()
+        self.assertIsNone(tries())
+
+    @unittest.skipIf(BertWordPieceTokenizer is None, "requires the tokenizers library")
+    def test_fast_tokenizer(self):
+        vocab_tokens = [
+            "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+            "##ing", ","
+        ]
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+            vocab_file = vocab_writer.name
+
+        tokenizer = BertTokenizer(vocab_file)
+        fast_tokenizer = BertTokenizer(vocab_file, use_fast=True)
+        os.remove(vocab_file)
+        self.assertIsNotNone(fast_tokenizer._fast)
+
+        texts = [u"UNwant\u00E9d,running", u"", u"[SEP] wa", u"ah\u535A\u63A8zz unwanted"]
+        for text in texts:
+            self.assertListEqual(fast_tokenizer.tokenize(text), tokenizer.tokenize(text))
+        self.assertListEqual(fast_tokenizer.encode_batch(texts), tokenizer.encode_batch(texts))
+
+        # Without [CLS] and [SEP] the fast backend can't be built, the Python one is used.
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in ["[UNK]", "want", "##ed"]]))
+            vocab_file = vocab_writer.name
+
+        with self.assertLogs("pytorch_pretrained_bert.tokenization", level="WARNING"):
+            fast_tokenizer = BertTokenizer(vocab_file, use_fast=True)
+        os.remove(vocab_file)
+        self.assertIsNone(fast_tokenizer._fast)
+        self.assertListEqual(fast_tokenizer.tokenize(u"wanted"), ["want", "##ed"])
+
+    def test_tokenize_batch(self):
+        vocab_tokens = [
+            "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+            "##ing", ","
+        ]
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+            vocab_file = vocab_writer.name
+
+        tokenizer = BertTokenizer(vocab_file)
+        os.remove(vocab_file)
+
+        texts = [u"UNwant\u00E9d,running", u"", u"[SEP] wa"] * 4
+        expected = [tokenizer.tokenize(text) for text in texts]
+        self.assertListEqual(tokenizer.tokenize_batch(texts, n_workers=1), expected)
+        self.assertListEqual(tokenizer.tokenize_batch(texts, n_workers=2, chunksize=2), expected)
+
+    def test_convert_ids_to_tokens_with_duplicated_vocab_lines(self):
+        vocab_tokens = ["[UNK]", "want", "un", "want", "##ed"]
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+            vocab_file = vocab_writer.name
+
+        tokenizer = BertTokenizer(vocab_file)
+        os.remove(vocab_file)
+
+        self.assertListEqual(tokenizer.convert_ids_to_tokens([2, 3, 4]), ["un", "want", "##ed"])
+        self.assertRaises(KeyError, tokenizer.convert_ids_to_tokens, [1])
+        self.assertRaises(KeyError, tokenizer.convert_ids_to_tokens, [-1])
+
+    def test_load_vocab(self):
+        with open("/tmp/bert_tokenizer_test.txt", "wb") as vocab_writer:
+            vocab_writer.write(u"[UNK]\r\nwant \n\n##ed\r\u00E9\n##ing".encode("utf-8"))
+            vocab_file = vocab_writer.name
+
+        vocab = load_vocab(vocab_file)
+        os.remove(vocab_file)
+        self.assertListEqual(list(vocab.items()),
+                             [("[UNK]", 0), ("want", 1), ("", 2), ("##ed", 3), (u"\u00E9", 4), ("##ing", 5)])
+
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_file = vocab_writer.name
+        self.assertEqual(len(load_vocab(vocab_file)), 0)
+        os.remove(vocab_file)
+
+    def test_reload_modified_vocab(self):
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in ["[UNK]", "want", "##ed"]]))
+            vocab_file = vocab_writer.name
+
+        tokenizer = BertTokenizer(vocab_file)
+        self.assertIs(BertTokenizer(vocab_file).vocab, tokenizer.vocab)
+
+        # Rewritten in place.
+        with open(vocab_file, "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in ["[UNK]", "un", "##want", "##ed"]]))
+        rewritten_tokenizer = BertTokenizer(vocab_file)
+        self.assertListEqual(rewritten_tokenizer.tokenize(u"unwanted"), ["un", "##want", "##ed"])
+        self.assertListEqual(rewritten_tokenizer.convert_ids_to_tokens([1, 2]), ["un", "##want"])
+
+        # Replaced by a file of the same size and modification time, only the inode differs.
+        stat = os.stat(vocab_file)
+        with open(vocab_file + ".new", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in ["[UNK]", "wa", "##nted", "##ed"]]))
+        os.utime(vocab_file + ".new", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(vocab_file + ".new", vocab_file)
+        replaced_tokenizer = BertTokenizer(vocab_file)
+        os.remove(vocab_file)
+        self.assertListEqual(replaced_tokenizer.tokenize(u"wanted"), ["wa", "##nted"])
+
+        # The existing tokenizers keep the vocab they were built with.
+        self.assertListEqual(tokenizer.tokenize(u"wanted"), ["want", "##ed"])
+        self.assertListEqual(tokenizer.convert_tokens_to_ids(["want", "##ed"]), [1, 2])
+        self.assertListEqual(rewritten_tokenizer.tokenize(u"unwanted"), ["un", "##want", "##ed"])
+
     def test_chinese(self):
         tokenizer = BasicTokenizer()
 
@@ -76,6 +232,8 @@ class TokenizationTest(unittest.TestCase):
             tokenizer.tokenize(u" \tHeLLo!how  \n Are yoU?  "),
             ["hello", "!", "how", "are", "you", "?"])
         self.assertListEqual(tokenizer.tokenize(u"H\u00E9llo"), ["hello"])
+        self.assertListEqual(
+            tokenizer.tokenize(u"[CLS] HeLLo [SEP]"), ["[CLS]", "hello", "[SEP]"])
 
     def test_basic_tokenizer_no_lower(self):
         tokenizer = BasicTokenizer(do_lower_case=False)
@@ -104,6 +262,32 @@ class TokenizationTest(unittest.TestCase):
         self.assertListEqual(
             tokenizer.tokenize("unwantedX running"), ["[UNK]", "runn", "##ing"])
 
+        self.assertListEqual(
+            tokenizer.tokenize("running unwanted running"),
+            ["runn", "##ing", "un", "##want", "##ed", "runn", "##ing"])
+        self.assertGreater(tokenizer._tokenize_word.cache_info().hits, 0)
+
+    def test_wordpiece_tokenizer_implementations(self):
+        vocab_tokens = [
+            "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+            "##ing"
+        ]
+        vocab = dict((token, i) for i, token in enumerate(vocab_tokens))
+
+        implementations = {"python": None}
+        if tokenization._compiled_tokenize_word is not None:
+            implementations["compiled"] = tokenization._compiled_tokenize_word
+        for name, implementation in implementations.items():
+            with mock.patch.object(tokenization, "_compiled_tokenize_word", implementation):
+                for vocab_type in (dict, collections.OrderedDict):
+                    with self.subTest(implementation=name, vocab_type=vocab_type.__name__):
+                        tokenizer = WordpieceTokenizer(vocab=vocab_type(vocab), max_input_chars_per_word=10)
+                        self.assertEqual(tokenizer._use_compiled,
+                                         implementation is not None and vocab_type is dict)
+                        self.assertListEqual(
+                            tokenizer.tokenize("unwanted running wa unwantedX ##ed unwantedunwanted"),
+                            ["un", "##want", "##ed", "runn", "##ing", "wa", "[UNK]", "##ed", "[UNK]"])
+
     def test_is_whitespace(self):
         self.assertTrue(_is_whitespace(u" "))
         self.assertTrue(_is_whitespace(u"\t"))